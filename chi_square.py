@@ -8,6 +8,10 @@ from timeit import default_timer as timer
 import itertools
 import re
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from collections import defaultdict
 import heapq
 from typing import Optional
@@ -15,99 +19,152 @@ from typing import Optional
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# a token is a run of at least two non-delimiter characters
+_TOKEN_RE = re.compile(r'''[^\s\d()\[\]{}.!?,;:+=\-_"'`~#@&*%€$§/\\]{2,}''')
+
+# the ASCII delimiters of _TOKEN_RE mapped to spaces: on ASCII text,
+# translate + split tokenizes the same way without the regex engine
+_ASCII_DELIMS = str.maketrans(dict.fromkeys('()[]{}.!?,;:+=-_"\'`~#@&*%$/\\0123456789', ' '))
+
+def _loads(line):
+    """Parse a JSON line, with orjson when it is installed"""
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # orjson rejects some input json accepts, e.g. lone surrogate escapes and NaN
+            pass
+    return json.loads(line)
+
 class ChiSquareJob(MRJob):
     OUTPUT_PROTOCOL = mrjob.protocol.TextProtocol
+    # values reach the reducers sorted, so category totals arrive before terms
+    SORT_VALUES = True
     
     def configure_args(self):
         super(ChiSquareJob, self).configure_args()
         self.add_file_arg("--stopwords", help="path to stopwords file")
     
     def mapper_init(self):
-        self.stopwords = set()
         with open(self.options.stopwords, "r") as f:
-            self.stopwords = set(line.strip() for line in f)
+            self.stopwords = frozenset(line.strip().lower() for line in f)
+        # in-mapper combining: counts are aggregated across all lines of the split
+        self.local = defaultdict(int)
     
     def mapper(self, _, line):
-        json_dict = json.loads(line)
+        # local name is cheaper to look up in the loop below
+        local = self.local
+        
+        json_dict = _loads(line)
         review_text = json_dict["reviewText"]
         category = json_dict["category"]
         
         # tokenization, case folding, stopword removal
-        terms = re.split(r'[ \t\d()\[\]{}.!?,;:+=\-_"\'~#@&*%€$§\/]+', review_text)
-        terms = set(terms) - self.stopwords
-        terms = [t.lower() for t in terms if len(t) > 1]
+        text = review_text.lower()
+        if text.isascii():
+            terms = {t for t in text.translate(_ASCII_DELIMS).split() if len(t) > 1}
+        else:
+            terms = set(_TOKEN_RE.findall(text))
+        # removing stopwords after deduplication tests each distinct token once
+        terms -= self.stopwords
         
         for term in terms:
-            yield (term, category), 1
+            local[(term, category)] += 1
         
         # each line corresponds to exactly one category
-        yield (None, category), 1
+        local[(None, category)] += 1
+    
+    def mapper_final(self):
+        for key, count in self.local.items():
+            yield key, count
+        self.local.clear()
     
     def combiner(self, key, counts):
-        yield None, (key, sum(counts))
+        yield key, sum(counts)
+    
+    def reducer_count(self, key, counts):
+        # re-key by term; category sizes all end up under the None term
+        term, cat = key
+        yield term, (cat, sum(counts))
     
-    def reducer(self, _, key_count):
-        N = 0
-        cat_count = defaultdict(int)
-        term_count = defaultdict(int)
-        term_cat_count = defaultdict(int)
+    def reducer_term_total(self, term, cat_counts):
+        cat_counts = list(cat_counts)
         
-        for key, count in key_count:
-            term, cat = key
-            if term is None:
-                N += count
-                cat_count[cat] = count
-            else:
-                term_count[term] += count
-                term_cat_count[(term, cat)] = count
+        # one record per category: broadcast category size and N to every category
+        # tag 0 sorts before the term records (tag 1), see SORT_VALUES
+        if term is None:
+            N = sum(count for _, count in cat_counts)
+            for cat, count in cat_counts:
+                yield cat, (0, count, N)
+            return
         
-        # 1. calculate chi2 of all terms for each category
-        # can't merge with previous loop because we need to calculate N first
-        chi2_cat_term = {}
-        for (term, cat) in term_cat_count:
-            A = term_cat_count[(term, cat)]
-            B = term_count[term] - A
-            C = cat_count[cat] - A
-            D = N - A - B - C
-            
+        term_count = sum(count for _, count in cat_counts)
+        for cat, A in cat_counts:
+            yield cat, (1, term, A, term_count)
+    
+    def reducer_chi_square(self, cat, values):
+        # first value is (0, docs in category, N)
+        _, cat_count, N = next(values)
+        
+        # A+B = term_count, A+C = cat_count, B+D = N - cat_count and
+        # C+D = N - term_count, so the denominator does not depend on A and
+        # A*D - B*C = N*A - term_count*cat_count.
+        # The category half of the denominator is the same for every term.
+        cat_factor = cat_count * (N - cat_count)
+        
+        # only the top 75 are held in memory, in a min-heap
+        heap = []
+        for _, term, A, term_count in values:
             # Avoid division by zero
-            denominator = (A + B) * (A + C) * (B + D) * (C + D)
+            denominator = term_count * (N - term_count) * cat_factor
             if denominator == 0:
                 chi2 = 0
             else:
-                chi2 = (N * (A * D - B * C) ** 2) / denominator
-                
-            if cat not in chi2_cat_term:
-                chi2_cat_term[cat] = {}
-            chi2_cat_term[cat][term] = chi2
-        
-        # 2. sort chi2 keys alphabetically
-        chi2_cat_term = dict(sorted(chi2_cat_term.items(), key=lambda x: x[0]))
+                chi2 = (N * (N * A - term_count * cat_count) ** 2) / denominator
+            
+            if len(heap) < 75:
+                heapq.heappush(heap, (chi2, term))
+            else:
+                heapq.heappushpop(heap, (chi2, term))
         
-        # 3. sort chi2 values and get top 75
-        for cat, terms in chi2_cat_term.items():
-            chi2_cat_term[cat] = dict(heapq.nlargest(75, terms.items(), key=lambda x: x[1]))
-            if not chi2_cat_term[cat]:
-                del chi2_cat_term[cat]
+        if heap:
+            yield None, (cat, [(term, chi2) for chi2, term in sorted(heap, reverse=True)])
+    
+    def reducer(self, _, cat_top_terms):
+        # at most 75 terms per category reach this reducer
+        chi2_cat_term = dict(sorted(cat_top_terms, key=lambda x: x[0]))
         
-        # 4. yield results
         # <category name> term1:chi2 term2:chi2 ... term75:chi2
         for cat, terms in chi2_cat_term.items():
-            yield None, str(cat) + " " + " ".join(f"{term}:{chi2}" for term, chi2 in terms.items())
+            yield None, str(cat) + " " + " ".join([f"{term}:{chi2!r}" for term, chi2 in terms])
         
-        # 5. all terms space-separated and ordered alphabetically
+        # all terms space-separated and ordered alphabetically
         all_terms = set()
-        for terms_dict in chi2_cat_term.values():
-            all_terms.update(terms_dict.keys())
+        for terms in chi2_cat_term.values():
+            all_terms.update(term for term, _ in terms)
         
         yield None, " ".join(sorted(all_terms))
     
     def steps(self):
         return [
+            # 1. count documents per (term, category) and per category
             MRStep(
                 mapper_init=self.mapper_init,
                 mapper=self.mapper,
+                mapper_final=self.mapper_final,
                 combiner=self.combiner,
+                reducer=self.reducer_count,
+            ),
+            # 2. documents per term, grouped by term
+            MRStep(
+                reducer=self.reducer_term_total,
+            ),
+            # 3. chi2 and top 75, grouped by category
+            MRStep(
+                reducer=self.reducer_chi_square,
+            ),
+            # 4. merge the per-category results into the final output
+            MRStep(
                 reducer=self.reducer,
             ),
         ]
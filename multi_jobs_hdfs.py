@@ -3,156 +3,300 @@
 Multi-job implementation of chi-square analysis for Hadoop
 Modified to work with HDFS files
 """
+import io
 import os
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import re
 import heapq
 import logging
 import subprocess
+import tempfile
+from array import array
 from timeit import default_timer as timer
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice
+from multiprocessing import Pool
+
+import numpy as np
+from scipy import sparse
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# a token is a run of at least two non-delimiter characters
+_TOKEN_RE = re.compile(r'''[^\s\d()\[\]{}.!?,;:+=\-_"'`~#@&*%€$§/\\]{2,}''')
+
+# the ASCII delimiters of _TOKEN_RE mapped to spaces: on ASCII text,
+# translate + split tokenizes the same way without the regex engine
+_ASCII_DELIMS = str.maketrans(dict.fromkeys('()[]{}.!?,;:+=-_"\'`~#@&*%$/\\0123456789', ' '))
+
+# Read buffer for streaming HDFS files
+_HDFS_READ_BUFFER = 4 << 20
+
+# Review lines handed to a worker process at a time
+_CHUNK_LINES = 10000
+
+# (term id, category id) counts buffered before they are folded into the count matrix
+_FLUSH_PAIRS = 1 << 22
+
+# Stopwords of the current worker process, set by init_worker
+_worker_stopwords = None
+
+def _loads(line):
+    """Parse a JSON line, with orjson when it is installed"""
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # orjson rejects some input json accepts, e.g. lone surrogate escapes and NaN
+            pass
+    return json.loads(line)
+
 def load_stopwords(filepath):
     """Load stopwords from local file"""
     with open(filepath, 'r') as f:
-        return set(line.strip().lower() for line in f)
+        return frozenset(line.strip().lower() for line in f)
 
 def read_hdfs_file(hdfs_path):
-    """Read a file from HDFS using Hadoop command"""
+    """Stream the lines of a file from HDFS using Hadoop command"""
     logger.info(f"Reading HDFS file: {hdfs_path}")
-    cmd = ["hadoop", "fs", "-cat", hdfs_path]
+    # -text also decompresses compressed inputs, without a separate zcat
+    cmd = ["hadoop", "fs", "-text", hdfs_path]
     logger.info(f"Running command: {' '.join(cmd)}")
     
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    output, error = process.communicate()
+    # stderr goes to a temporary file: nothing reads a stderr pipe while stdout
+    # is streamed, so hadoop would block once its warnings filled the pipe buffer
+    with tempfile.TemporaryFile() as stderr:
+        # stdout is a BufferedReader with a large buffer; decode it ourselves
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr,
+                                   bufsize=_HDFS_READ_BUFFER)
+        stdout = io.TextIOWrapper(process.stdout, encoding="utf-8", errors="replace", newline="\n")
+        
+        try:
+            # Yield lines as they arrive instead of buffering the whole file
+            for line in stdout:
+                yield line
+            process.wait()
+        finally:
+            stdout.close()
+            # a generator abandoned before the end must not leave hadoop running
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+        
+        if process.returncode != 0:
+            stderr.seek(0)
+            error = stderr.read().decode("utf-8", errors="replace")
+            logger.error(f"Error reading HDFS file: {error}")
+            raise Exception(f"Failed to read HDFS file: {error}")
+
+def read_local_file(filepath):
+    """Stream the lines of a local file"""
+    with open(filepath, 'r') as f:
+        yield from f
+
+def add_counts(counts, rows, cols, data, shape):
+    """Fold buffered (term id, category id, count) entries into a sparse count matrix"""
+    chunk = sparse.coo_matrix((np.asarray(data, dtype=np.int64), (np.asarray(rows), np.asarray(cols))),
+                              shape=shape).tocsr()
+    if counts is None:
+        return chunk
+    counts.resize(shape)
+    return counts + chunk
+
+def init_worker(stopwords):
+    """Give a worker process its stopwords once instead of with every chunk"""
+    global _worker_stopwords
+    _worker_stopwords = stopwords
+
+def count_chunk(lines):
+    """
+    Parse and tokenize a chunk of review lines in a worker process
+    Returns: document count, category doc counts and (term, category) doc counts
+    """
+    # local names are cheaper to look up in the loops below
+    stopwords = _worker_stopwords
+    findall = _TOKEN_RE.findall
+    delims = _ASCII_DELIMS
+    
+    docs = 0
+    category_docs = defaultdict(int)    # Category -> doc count
+    term_cat_counts = defaultdict(int)  # (Term, Category) -> doc count
     
-    if process.returncode != 0:
-        logger.error(f"Error reading HDFS file: {error}")
-        raise Exception(f"Failed to read HDFS file: {error}")
+    for line in lines:
+        try:
+            review = _loads(line)
+        except json.JSONDecodeError:
+            logger.warning(f"Invalid JSON in line: {line[:100]}...")
+            continue
+        
+        category = review.get('category', '')
+        text = review.get('reviewText', '')
+        if not category or not text:
+            continue
+        
+        # Tokenize and count unique terms in this document
+        text = text.lower()
+        if text.isascii():
+            unique_terms = {t for t in text.translate(delims).split() if len(t) > 1}
+        else:
+            unique_terms = set(findall(text))
+        # removing stopwords after deduplication tests each distinct token once
+        unique_terms -= stopwords
+        
+        docs += 1
+        category_docs[category] += 1
+        for term in unique_terms:
+            term_cat_counts[(term, category)] += 1
     
-    # Split the output into lines
-    return output.splitlines()
+    return docs, dict(category_docs), dict(term_cat_counts)
 
-def process_reviews(input_file, stopwords):
+def imap_bounded(pool, func, iterable, window):
+    """
+    Like Pool.imap, but with at most `window` tasks queued at a time, so a
+    streamed input is not read into memory faster than the workers consume it
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def process_reviews(input_file, stopwords, workers=None):
     """
     Job 1: Process reviews and count documents and terms
-    Input file can be HDFS path
-    Returns: document counts, term counts, and term-category counts
+    Input file can be HDFS path; chunks of lines are tokenized in parallel by
+    `workers` processes (default: one per CPU)
+    Returns: document counts, category names and terms (indexed by id),
+    per-category document counts, per-term document counts, and a sparse
+    (term id x category id) matrix of term-category document counts
     """
     logger.info("Job 1: Processing reviews and counting documents and terms")
     
     total_docs = 0
-    category_docs = defaultdict(int)  # Category -> doc count
-    term_counts = defaultdict(int)    # Term -> doc count
-    term_cat_counts = defaultdict(int)  # (Term, Category) -> doc count
+    cat_to_id = {}                    # Category -> category id
+    category_docs = []                # Category id -> doc count
+    term_to_id = {}                   # Term -> term id
+    rows = array('i')                 # Term id of each buffered count
+    cols = array('i')                 # Category id of each buffered count
+    data = array('i')                 # Buffered (Term id, Category id) doc counts
+    term_cat_counts = None            # Sparse (Term id, Category id) -> doc count
     
-    # Determine if the input is an HDFS path
-    if input_file.startswith("hdfs://"):
+    # Determine if the input is an HDFS path; a missing local file may be
+    # an HDFS path without the 'hdfs://' prefix
+    if input_file.startswith("hdfs://") or not os.path.isfile(input_file):
         lines = read_hdfs_file(input_file)
     else:
-        # Try local file
-        try:
-            with open(input_file, 'r') as f:
-                lines = f.readlines()
-        except FileNotFoundError:
-            # Maybe it's an HDFS path without the 'hdfs://' prefix
-            lines = read_hdfs_file(input_file)
+        lines = read_local_file(input_file)
     
-    for line in lines:
-        try:
-            review = json.loads(line)
-            category = review.get('category', '')
-            text = review.get('reviewText', '')
-            
-            if not category or not text:
-                continue
-            
-            # Tokenize and process text
-            terms = re.split(r'[ \t\d()\[\]{}.!?,;:+=\-_"\'`~#@&*%€$§\/]+', text.lower())
-            terms = [t for t in terms if t and t not in stopwords and len(t) > 1]
-            
-            # Count unique terms in this document
-            unique_terms = set(terms)
+    workers = workers or os.cpu_count() or 1
+    chunks = iter(lambda: list(islice(lines, _CHUNK_LINES)), [])
+    
+    # local names are cheaper to look up in the loops below
+    get_term_id = term_to_id.get
+    rows_append = rows.append
+    cols_append = cols.append
+    data_append = data.append
+    
+    with Pool(workers, initializer=init_worker, initargs=(stopwords,)) as pool:
+        for docs, chunk_category_docs, chunk_counts in imap_bounded(pool, count_chunk, chunks, 2 * workers):
+            # Small integer ids hash and compare faster than category strings
+            chunk_cat_ids = {}
+            for category, count in chunk_category_docs.items():
+                cat_id = cat_to_id.get(category)
+                if cat_id is None:
+                    cat_id = cat_to_id[category] = len(category_docs)
+                    category_docs.append(0)
+                category_docs[cat_id] += count
+                chunk_cat_ids[category] = cat_id
             
-            # Update counts
-            total_docs += 1
-            category_docs[category] += 1
+            for (term, category), count in chunk_counts.items():
+                term_id = get_term_id(term)
+                if term_id is None:
+                    term_id = term_to_id[term] = len(term_to_id)
+                rows_append(term_id)
+                cols_append(chunk_cat_ids[category])
+                data_append(count)
             
-            for term in unique_terms:
-                term_counts[term] += 1
-                term_cat_counts[(term, category)] += 1
+            if len(rows) >= _FLUSH_PAIRS:
+                term_cat_counts = add_counts(term_cat_counts, rows, cols, data,
+                                             (len(term_to_id), len(category_docs)))
+                del rows[:], cols[:], data[:]
             
             # Log progress for large datasets
-            if total_docs % 10000 == 0:
-                logger.info(f"Processed {total_docs} documents...")
-                
-        except json.JSONDecodeError:
-            logger.warning(f"Invalid JSON in line: {line[:100]}...")
-            continue
+            total_docs += docs
+            logger.info(f"Processed {total_docs} documents...")
+    
+    term_cat_counts = add_counts(term_cat_counts, rows, cols, data, (len(term_to_id), len(category_docs)))
+    term_counts = np.asarray(term_cat_counts.sum(axis=1)).ravel()
     
     logger.info(f"Processed {total_docs} documents across {len(category_docs)} categories")
-    logger.info(f"Found {len(term_counts)} unique terms and {len(term_cat_counts)} term-category pairs")
+    logger.info(f"Found {len(term_to_id)} unique terms and {term_cat_counts.nnz} term-category pairs")
     
-    return total_docs, category_docs, term_counts, term_cat_counts
+    return (total_docs, list(cat_to_id), list(term_to_id),
+            np.asarray(category_docs, dtype=np.int64), term_counts, term_cat_counts)
 
-def calculate_chi_square(total_docs, category_docs, term_counts, term_cat_counts):
+def calculate_top_terms(total_docs, categories, terms, category_docs, term_counts, term_cat_counts, top_n=75):
     """
-    Job 2: Calculate chi-square values for each term-category pair
-    Returns: Dictionary of {category -> {term -> chi_square}}
+    Job 2: Calculate chi-square values for each term-category pair and select
+    the top N terms for each category in the same pass
+    Returns: Dictionary of {category -> [(term, chi_square), ...]} and the
+    sorted merged dictionary
     """
-    logger.info("Job 2: Calculating chi-square values")
+    logger.info(f"Job 2: Calculating chi-square values and selecting top {top_n} terms per category")
     
-    chi_square_values = defaultdict(dict)
-    count = 0
-    total_pairs = len(term_cat_counts)
+    # Term id and category id of every stored entry of the CSR matrix
+    total_pairs = term_cat_counts.nnz
+    pair_terms = np.repeat(np.arange(term_cat_counts.shape[0]), np.diff(term_cat_counts.indptr))
+    pair_categories = term_cat_counts.indices
     
-    for (term, category), count_a in term_cat_counts.items():
-        # A = docs in category with term
-        a = count_a
-        
-        # B = docs not in category with term
-        b = term_counts[term] - a
-        
-        # C = docs in category without term
-        c = category_docs[category] - a
-        
-        # D = docs not in category without term
-        d = total_docs - a - b - c
-        
-        # Calculate chi-square
-        denominator = (a + b) * (a + c) * (b + d) * (c + d)
-        if denominator == 0:
-            chi_square = 0
+    # float64 rather than int64: N * (a*d - b*c)^2 and the denominator
+    # overflow int64 on large corpora
+    term_total = term_counts.astype(np.float64)
+    category_total = category_docs.astype(np.float64)
+    
+    # A = docs in category with term, A+B = docs with term, A+C = docs in
+    # category, so B+D = N - (A+C) and C+D = N - (A+B). The denominator
+    # (A+B)(A+C)(B+D)(C+D) does not depend on A: its two halves are computed
+    # once per term and once per category, then gathered per pair.
+    term_factor = term_total * (total_docs - term_total)
+    category_factor = category_total * (total_docs - category_total)
+    denominator = term_factor[pair_terms] * category_factor[pair_categories]
+    
+    # A*D - B*C = N*A - (A+B)(A+C)
+    a = term_cat_counts.data.astype(np.float64)
+    numerator = total_docs * (total_docs * a - term_total[pair_terms] * category_total[pair_categories]) ** 2
+    
+    # Calculate chi-square, 0 where the denominator is 0
+    chi_square = np.divide(numerator, denominator,
+                           out=np.zeros_like(numerator), where=denominator != 0)
+    values = chi_square.tolist()
+    # those pairs are printed as an integer 0, like the other implementations do
+    for i in np.flatnonzero(denominator == 0).tolist():
+        values[i] = 0
+    
+    # Push every value straight into a bounded min-heap per category
+    heaps = defaultdict(list)
+    for term_id, cat_id, value in zip(pair_terms.tolist(), pair_categories.tolist(), values):
+        heap = heaps[cat_id]
+        if len(heap) < top_n:
+            heapq.heappush(heap, (value, terms[term_id]))
         else:
-            chi_square = (total_docs * ((a * d - b * c) ** 2)) / denominator
-        
-        chi_square_values[category][term] = chi_square
-        
-        # Log progress
-        count += 1
-        if count % 100000 == 0:
-            logger.info(f"Calculated {count}/{total_pairs} chi-square values ({count/total_pairs*100:.1f}%)")
+            heapq.heappushpop(heap, (value, terms[term_id]))
     
-    logger.info(f"Calculated chi-square values for {len(term_cat_counts)} term-category pairs")
-    return chi_square_values
-
-def select_top_terms(chi_square_values, top_n=75):
-    """
-    Job 3: Select top N terms for each category based on chi-square values
-    Returns: Dictionary of {category -> [(term, chi_square), ...]}
-    """
-    logger.info(f"Job 3: Selecting top {top_n} terms per category")
+    logger.info(f"Calculated chi-square values for {total_pairs} term-category pairs")
     
     top_terms = {}
     merged_dict = set()
-    
-    for category, terms in chi_square_values.items():
-        # Get top N terms for this category
-        category_top_terms = heapq.nlargest(top_n, terms.items(), key=lambda x: x[1])
-        top_terms[category] = category_top_terms
+    for cat_id, heap in heaps.items():
+        category_top_terms = [(term, value) for value, term in sorted(heap, reverse=True)]
+        top_terms[categories[cat_id]] = category_top_terms
         
         # Add terms to merged dictionary
         merged_dict.update(term for term, _ in category_top_terms)
@@ -164,17 +308,17 @@ def select_top_terms(chi_square_values, top_n=75):
 
 def format_output(top_terms, merged_dict):
     """
-    Job 4: Format the final output
+    Job 3: Format the final output
     Returns: List of output lines
     """
-    logger.info("Job 4: Formatting output")
+    logger.info("Job 3: Formatting output")
     
     output_lines = []
     
     # Add category lines in alphabetical order
     for category in sorted(top_terms.keys()):
         terms = top_terms[category]
-        formatted = f"{category} " + " ".join([f"{term}:{chi_square}" for term, chi_square in terms])
+        formatted = f"{category} " + " ".join([f"{term}:{chi_square!r}" for term, chi_square in terms])
         output_lines.append(formatted)
     
     # Add merged dictionary line
@@ -192,15 +336,14 @@ def run_multi_job_pipeline(input_file, stopwords_file, output_file):
         logger.info(f"Loaded {len(stopwords)} stopwords")
         
         # Job 1: Process reviews and count documents
-        total_docs, category_docs, term_counts, term_cat_counts = process_reviews(input_file, stopwords)
-        
-        # Job 2: Calculate chi-square values
-        chi_square_values = calculate_chi_square(total_docs, category_docs, term_counts, term_cat_counts)
+        (total_docs, categories, terms, category_docs,
+         term_counts, term_cat_counts) = process_reviews(input_file, stopwords)
         
-        # Job 3: Select top terms per category
-        top_terms, merged_dict = select_top_terms(chi_square_values)
+        # Job 2: Calculate chi-square values and select top terms per category
+        top_terms, merged_dict = calculate_top_terms(total_docs, categories, terms, category_docs,
+                                                     term_counts, term_cat_counts)
         
-        # Job 4: Format output
+        # Job 3: Format output
         output_lines = format_output(top_terms, merged_dict)
         
         # Write output to file
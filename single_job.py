@@ -4,6 +4,10 @@ from mrjob.step import MRStep
 import mrjob.protocol
 import re
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import logging
 from timeit import default_timer as timer
 from collections import defaultdict
@@ -12,6 +16,23 @@ import heapq
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# a token is a run of at least two non-delimiter characters
+_TOKEN_RE = re.compile(r'''[^\s\d()\[\]{}.!?,;:+=\-_"'`~#@&*%€$§/\\]{2,}''')
+
+# the ASCII delimiters of _TOKEN_RE mapped to spaces: on ASCII text,
+# translate + split tokenizes the same way without the regex engine
+_ASCII_DELIMS = str.maketrans(dict.fromkeys('()[]{}.!?,;:+=-_"\'`~#@&*%$/\\0123456789', ' '))
+
+def _loads(line):
+    """Parse a JSON line, with orjson when it is installed"""
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # orjson rejects some input json accepts, e.g. lone surrogate escapes and NaN
+            pass
+    return json.loads(line)
+
 class ChiSquareJob(MRJob):
     OUTPUT_PROTOCOL = mrjob.protocol.TextProtocol
     
@@ -20,80 +41,97 @@ class ChiSquareJob(MRJob):
         self.add_file_arg("--stopwords", help="path to stopwords file")
     
     def mapper_init(self):
-        self.stopwords = set()
         with open(self.options.stopwords, "r") as f:
-            self.stopwords = set(line.strip() for line in f)
+            self.stopwords = frozenset(line.strip().lower() for line in f)
+        # in-mapper combining: counts are aggregated across all lines of the split
+        self.local = defaultdict(int)
     
     def mapper(self, _, line):
-        json_dict = json.loads(line)
+        # local name is cheaper to look up in the loop below
+        local = self.local
+        
+        json_dict = _loads(line)
         review_text = json_dict["reviewText"]
         category = json_dict["category"]
         
         # tokenization, case folding, stopword removal
-        terms = re.split(r'[ \t\d()\[\]{}.!?,;:+=\-_"\'~#@&*%€$§\/]+', review_text)
-        terms = set(terms) - self.stopwords
-        terms = [t.lower() for t in terms if len(t) > 1]
+        text = review_text.lower()
+        if text.isascii():
+            terms = {t for t in text.translate(_ASCII_DELIMS).split() if len(t) > 1}
+        else:
+            terms = set(_TOKEN_RE.findall(text))
+        # removing stopwords after deduplication tests each distinct token once
+        terms -= self.stopwords
         
         for term in terms:
-            yield (term, category), 1
+            local[(term, category)] += 1
         
         # each line corresponds to exactly one category
-        yield (None, category), 1
+        local[(None, category)] += 1
     
-    def combiner(self, key, counts):
-        yield None, (key, sum(counts))
+    def mapper_final(self):
+        # the counts are already combined per task, so they go to the single reducer as is
+        for key, count in self.local.items():
+            yield None, (key, count)
+        self.local.clear()
     
     def reducer(self, _, key_count):
         N = 0
-        cat_count = defaultdict(int)
+        cat_ids = {}  # category -> small integer id
+        cat_count = []  # category id -> doc count
         term_count = defaultdict(int)
-        term_cat_count = defaultdict(int)
+        term_cat_count = defaultdict(int)  # (term, category id) -> doc count
         
         for key, count in key_count:
             term, cat = key
+            cat_id = cat_ids.get(cat)
+            if cat_id is None:
+                cat_id = cat_ids[cat] = len(cat_count)
+                cat_count.append(0)
+            
+            # several map tasks may report the same key, so counts are summed
             if term is None:
                 N += count
-                cat_count[cat] = count
+                cat_count[cat_id] += count
             else:
                 term_count[term] += count
-                term_cat_count[(term, cat)] = count
+                term_cat_count[(term, cat_id)] += count
+        
+        # A+B = term_count, A+C = cat_count, B+D = N - cat_count and
+        # C+D = N - term_count, so the denominator does not depend on A and
+        # A*D - B*C = N*A - term_count*cat_count.
+        # The category half of the denominator is computed once per category.
+        cat_factor = [cc * (N - cc) for cc in cat_count]
         
-        # 1. calculate chi2 of all terms for each category
-        chi2_cat_term = {}
-        for (term, cat) in term_cat_count:
-            A = term_cat_count[(term, cat)]
-            B = term_count[term] - A
-            C = cat_count[cat] - A
-            D = N - A - B - C
+        # 1. calculate chi2 of all terms, keeping the top 75 per category in a min-heap
+        heaps = defaultdict(list)
+        for (term, cat_id), A in term_cat_count.items():
+            tc = term_count[term]
+            cc = cat_count[cat_id]
             
             # Avoid division by zero
-            denominator = (A + B) * (A + C) * (B + D) * (C + D)
+            denominator = tc * (N - tc) * cat_factor[cat_id]
             if denominator == 0:
                 chi2 = 0
             else:
-                chi2 = (N * (A * D - B * C) ** 2) / denominator
-                
-            if cat not in chi2_cat_term:
-                chi2_cat_term[cat] = {}
-            chi2_cat_term[cat][term] = chi2
-        
-        # 2. sort chi2 keys alphabetically
-        chi2_cat_term = dict(sorted(chi2_cat_term.items(), key=lambda x: x[0]))
-        
-        # 3. sort chi2 values and get top 75
-        for cat, terms in chi2_cat_term.items():
-            chi2_cat_term[cat] = dict(heapq.nlargest(75, terms.items(), key=lambda x: x[1]))
-            if not chi2_cat_term[cat]:
-                del chi2_cat_term[cat]
-        
-        # 4. yield results
-        for cat, terms in chi2_cat_term.items():
-            yield None, str(cat) + " " + " ".join(f"{term}:{chi2}" for term, chi2 in terms.items())
+                chi2 = (N * (N * A - tc * cc) ** 2) / denominator
+            
+            h = heaps[cat_id]
+            if len(h) < 75:
+                heapq.heappush(h, (chi2, term))
+            else:
+                heapq.heappushpop(h, (chi2, term))
         
-        # 5. all terms space-separated and ordered alphabetically
+        # 2. yield results, categories alphabetically and terms by descending chi2
+        id_to_cat = list(cat_ids)
         all_terms = set()
-        for terms_dict in chi2_cat_term.values():
-            all_terms.update(terms_dict.keys())
+        for cat_id in sorted(heaps, key=id_to_cat.__getitem__):
+            cat = id_to_cat[cat_id]
+            top_terms = sorted(heaps[cat_id], reverse=True)
+            all_terms.update(term for _, term in top_terms)
+            yield None, str(cat) + " " + " ".join([f"{term}:{chi2!r}" for chi2, term in top_terms])
+        
+        # 3. all terms space-separated and ordered alphabetically
         yield None, " ".join(sorted(all_terms))
     
     def steps(self):
@@ -101,7 +139,7 @@ class ChiSquareJob(MRJob):
             MRStep(
                 mapper_init=self.mapper_init,
                 mapper=self.mapper,
-                combiner=self.combiner,
+                mapper_final=self.mapper_final,
                 reducer=self.reducer,
             ),
         ]
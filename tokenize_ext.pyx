@@ -0,0 +1,30 @@
+# cython: language_level=3
+"""
+Compiled tokenizer for the count mapper in run_chi
+
+Build in place with: cythonize -3 -a -i tokenize_ext.pyx
+"""
+import re
+
+# keep in sync with _TOKEN_RE and _ASCII_DELIMS in run_chi
+_TOKEN_RE = re.compile(r'''[^\s\d()\[\]{}.!?,;:+=\-_"'`~#@&*%€$§/\\]{2,}''')
+
+# the ASCII delimiters of _TOKEN_RE mapped to spaces: on ASCII text,
+# translate + split tokenizes the same way without the regex engine
+_ASCII_DELIMS = str.maketrans(dict.fromkeys('()[]{}.!?,;:+=-_"\'`~#@&*%$/\\0123456789', ' '))
+
+cpdef set tokenize(str text, frozenset stopwords, Py_ssize_t max_len=50):
+    """Return the unique lowercased tokens of text that are not stopwords"""
+    cdef set terms = set()
+    cdef str token
+    cdef Py_ssize_t length
+    text = text.lower()
+    if text.isascii():
+        tokens = text.translate(_ASCII_DELIMS).split()
+    else:
+        tokens = _TOKEN_RE.findall(text)
+    for token in tokens:
+        length = len(token)
+        if 1 < length < max_len and token not in stopwords:
+            terms.add(token)
+    return terms